@@ -19,8 +19,7 @@ TEMPLATES_DIR = str(project_root.joinpath("templates"))
 
 import prefect  # noqa
 
-database_dir = project_root.joinpath("database")
-database_dir.mkdir(parents=True, exist_ok=True)
+database_dir = project_root.joinpath("database")  # created on first connection
 database_file = "mfp_db.sqlite"
 database_path = database_dir.joinpath(database_file)
 DB_PATH = str(database_path)
@@ -7,19 +7,75 @@ Contains helper functions for various tasks.
 """
 
 import datetime
-from typing import List
+import heapq
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, islice
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 import myfitnesspal
 from prefect.run_configs import LocalRun
+from prefect.utilities.logging import get_logger
+from requests.adapters import HTTPAdapter
 
-from . import MFP_CONFIG_PATH, PYTHONPATH, ROOT_DIR
+from . import MFP_CONFIG_PATH, PYTHONPATH, ROOT_DIR, sql
 from .types import MaterializedDay
 
+if TYPE_CHECKING:
+    import dropbox
 
+_sqlite_connections: Dict[str, sqlite3.Connection] = {}
+_sqlite_connections_lock = threading.Lock()
+_myfitnesspal_clients: Dict[Tuple[str, str], myfitnesspal.Client] = {}
+_myfitnesspal_clients_lock = threading.Lock()
+# held while logging in, so one account's login does not block the other accounts
+_myfitnesspal_login_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_dropbox_clients: Dict[str, "dropbox.Dropbox"] = {}
+_dropbox_clients_lock = threading.Lock()
+
+# a child of the prefect logger, so the messages reach the handlers prefect configures
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+# seconds to wait for myfitnesspal to connect and to send each response
+_MYFITNESSPAL_REQUEST_TIMEOUT = 15
+
+# date formats accepted from users, each with a pattern matching its shape so strptime
+# only runs on strings it can parse; strptime also accepts dates without zero padding,
+# which `date.fromisoformat` rejects
+_DATE_FORMATS = (
+    ("%Y-%m-%d", re.compile(r"\d{4}-\d{1,2}-\d{1,2}")),
+    ("%d.%m.%Y", re.compile(r"\d{1,2}\.\d{1,2}\.\d{4}")),
+)
+# `date.fromisoformat` also accepts other ISO forms (e.g. "20210101") on newer Pythons,
+# so it is only used for strings of this shape
+_ISO_DATE_SHAPE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+@lru_cache(maxsize=1024)
 def try_parse_date_str(date_str: str) -> datetime.datetime:
     """
     Try to parse a date string using a set of provided formats.
 
+    Zero padded YYYY-MM-DD dates are parsed with `date.fromisoformat`, falling back to
+    the slower `strptime` for the rest of the formats. Results are cached.
+
     Args:
        - date_str (str): A string to be parsed as a date using the available formats
 
@@ -30,13 +86,20 @@ def try_parse_date_str(date_str: str) -> datetime.datetime:
        - ValueError: If the provided string can't be parsed using the available formats
     """
 
-    available_formats = ("%Y-%m-%d", "%d.%m.%Y", "%d.%m.%Y")
-
-    for fmt in available_formats:
+    if _ISO_DATE_SHAPE.fullmatch(date_str):
         try:
-            return datetime.datetime.strptime(date_str, fmt)
+            return datetime.datetime.combine(
+                datetime.date.fromisoformat(date_str), datetime.time()
+            )
         except ValueError:
             pass
+
+    for fmt, shape in _DATE_FORMATS:
+        if shape.fullmatch(date_str):
+            try:
+                return datetime.datetime.strptime(date_str, fmt)
+            except ValueError:
+                pass
     raise ValueError(f"No available format found to parse <{date_str}>.")
 
 
@@ -52,20 +115,195 @@ def select_fifo_backups_to_delete(max_num_backups: int, files_list: List) -> Lis
        - List: The list with the oldest files on the server due to be deleted
     """
 
-    timestamps = [
-        datetime.datetime.strptime(f.split("_")[3], "%Y-%m-%d") for f in files_list
-    ]
-    timestamps.sort()
-    if len(timestamps) <= max_num_backups:
+    num_to_delete = len(files_list) - max_num_backups
+    if num_to_delete <= 0:
         return []  # nothing to delete
-    cut_index = len(timestamps) - max_num_backups
-    return [f"mfp_db_backup_{ts.strftime('%Y-%m-%d')}" for ts in timestamps[:cut_index]]
+    # the %Y-%m-%d backup dates sort chronologically as plain strings
+    return heapq.nsmallest(num_to_delete, files_list, key=lambda f: f.split("_")[3])
+
+
+def get_sqlite_connection(
+    db: str, on_open: Optional[Callable[[sqlite3.Connection], None]] = None
+) -> sqlite3.Connection:
+    """
+    Return the connection to the provided sqlite database file shared by all tasks.
 
+    The connection is opened on first use and reused for the rest of the process, so
+    the page cache stays warm between tasks. It is opened in autocommit mode (see
+    `sqlite_transaction` for explicit transactions) and configured for bulk loading:
+    WAL journal, NORMAL synchronous mode, a ~100MB page cache and in-memory temporary
+    storage. Foreign key constraints are enforced, and up to 256 prepared statements
+    are kept in the connection's statement cache.
+
+    Args:
+       - db (str): The location of the database file
+       - on_open (Callable, optional): A function to run once against the connection
+         when it is opened
+
+    Returns:
+       - sqlite3.Connection: The shared connection to the database
+    """
+    key = str(db)
+    with _sqlite_connections_lock:
+        conn = _sqlite_connections.get(key)
+        if conn is None:
+            conn = sqlite3.connect(
+                key,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=256,
+            )
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            conn.execute("PRAGMA cache_size = -100000;")
+            conn.execute("PRAGMA temp_store = MEMORY;")
+            conn.execute("PRAGMA foreign_keys = YES;")
+            if on_open is not None:
+                on_open(conn)
+            _sqlite_connections[key] = conn
+    return conn
+
+
+def init_mfp_database(conn: sqlite3.Connection) -> None:
+    """
+    Create or upgrade the MyFitnessPaw database schema.
+
+    The database `user_version` records the schema version it was last set up with, so
+    up to date databases are left alone. All tables are created using the CREATE TABLE
+    IF NOT EXISTS clause, making this function safe to run against an already existing
+    database.
+
+    Args:
+       - conn (sqlite3.Connection): The connection to the database
+
+    Returns:
+       - None
+    """
+    if conn.execute("PRAGMA user_version;").fetchone()[0] >= sql.schema_version:
+        return
+    conn.executescript(sql.create_mfp_database)
+    # databases created before change detection by hash lack the hash column
+    columns = conn.execute("PRAGMA table_info(RawDayData);").fetchall()
+    if "rawdaydata_hash" not in (column[1] for column in columns):
+        conn.execute(sql.add_rawdaydata_hash_column)
+    conn.execute(f"PRAGMA user_version = {sql.schema_version};")
 
+
+def get_mfp_database_connection(db: str) -> sqlite3.Connection:
+    """
+    Return the shared connection to the MyFitnessPaw database.
+
+    The database directory and schema are created when the connection is first opened.
+
+    Args:
+       - db (str): The location of the database file
+
+    Returns:
+       - sqlite3.Connection: The shared connection to the database
+    """
+    with _sqlite_connections_lock:
+        is_open = str(db) in _sqlite_connections
+    if not is_open:
+        # creating the directory is idempotent, so racing callers are harmless; the
+        # schema is set up under the lock by `get_sqlite_connection`
+        Path(db).parent.mkdir(parents=True, exist_ok=True)
+    return get_sqlite_connection(db, on_open=init_mfp_database)
+
+
+def close_sqlite_connections() -> None:
+    """
+    Close all shared sqlite connections opened by `get_sqlite_connection`.
+    """
+    with _sqlite_connections_lock:
+        while _sqlite_connections:
+            _, conn = _sqlite_connections.popitem()
+            conn.close()
+
+
+@contextmanager
+def sqlite_transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """
+    Run the enclosed statements in a single explicit transaction.
+
+    The transaction is committed when the block exits and rolled back if it raises.
+    It is started as IMMEDIATE, so the write lock is taken up front instead of being
+    upgraded from a read lock in the middle of the transaction.
+
+    Args:
+       - conn (sqlite3.Connection): A connection opened in autocommit mode
+
+    Yields:
+       - sqlite3.Connection: The connection with an open transaction
+    """
+    conn.execute("BEGIN IMMEDIATE;")
+    # the connection context manager commits on exit and rolls back on error
+    with conn:
+        yield conn
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Split an iterable into consecutive lists of at most `size` items.
+
+    Args:
+       - iterable (Iterable): The items to be split
+       - size (int): The maximum number of items in a batch
+
+    Yields:
+       - List: The next batch of items
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def executemany_multirow(
+    conn: sqlite3.Connection,
+    query: str,
+    records: Iterable[Tuple],
+    max_params: int = 999,
+) -> None:
+    """
+    Execute a single row `INSERT ... VALUES (?, ...)` query for a sequence of records.
+
+    The records are packed into multi-row `VALUES (...), (...)` statements, with as many
+    rows per statement as the bound parameter limit allows, which saves stepping the
+    statement once per row.
+
+    Args:
+       - conn (sqlite3.Connection): The connection to execute the statements with
+       - query (str): A single row insert query ending with its `VALUES` clause
+       - records (Iterable[Tuple]): The records to be inserted
+       - max_params (int, optional): The maximum number of bound parameters in a
+         statement, defaults to SQLite's historical limit of 999
+
+    Returns:
+       - None
+
+    Raises:
+       - ValueError: if the query has no `VALUES` clause
+    """
+    single_row_query = query.strip().rstrip(";")
+    prefix, values_keyword, row_placeholders = single_row_query.rpartition("VALUES")
+    if not values_keyword:
+        raise ValueError("The query must be an INSERT ... VALUES (...) statement")
+    row_placeholders = row_placeholders.strip()
+    rows_per_statement = max(1, max_params // row_placeholders.count("?"))
+    for chunk in batched(records, rows_per_statement):
+        statement = f"{prefix}VALUES {', '.join([row_placeholders] * len(chunk))}"
+        conn.execute(statement, tuple(chain.from_iterable(chunk)))
+
+
+@lru_cache(maxsize=1)
 def get_local_run_config() -> LocalRun:
     """
     Return a LocalRun configuration to attach to a flow.
 
+    The configuration only depends on the project paths, so a single instance is built
+    and shared by all flows.
+
     Returns:
        - prefect.run_configs.LocalRun: The local run configuration to be applied to a flow
     """
@@ -78,6 +316,107 @@ def get_local_run_config() -> LocalRun:
     )
 
 
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    A transport adapter applying a default timeout to the requests sent through it.
+    """
+
+    def __init__(self, timeout: float, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def get_myfitnesspal_client(username: str, password: str) -> myfitnesspal.Client:
+    """
+    Return a logged in myfitnesspal client shared for the provided credentials.
+
+    Creating a client logs in to myfitnesspal, so the client is created once and
+    reused by every task (and thread) that fetches data for the same account. The
+    client's requests, including the login, time out after
+    `_MYFITNESSPAL_REQUEST_TIMEOUT` seconds instead of hanging on a stalled response.
+
+    Args:
+       - username (str): The username for the myfitnesspal account
+       - password (str): The password associated with the provided username
+
+    Returns:
+       - myfitnesspal.Client: The logged in client
+    """
+    key = (username, password)
+    with _myfitnesspal_clients_lock:
+        client = _myfitnesspal_clients.get(key)
+        if client is not None:
+            return client
+        login_lock = _myfitnesspal_login_locks.setdefault(key, threading.Lock())
+    with login_lock:
+        # another thread may have logged in to the account while this one waited
+        with _myfitnesspal_clients_lock:
+            client = _myfitnesspal_clients.get(key)
+        if client is None:
+            # the session only exists once the client is created, so the login is
+            # deferred until the timeout is in place; the library has no public way
+            # to log in a client created with `login=False`, hence the private call
+            client = myfitnesspal.Client(username, password, login=False)
+            adapter = _TimeoutHTTPAdapter(_MYFITNESSPAL_REQUEST_TIMEOUT)
+            client.session.mount("https://", adapter)
+            client.session.mount("http://", adapter)
+            client._login()
+            with _myfitnesspal_clients_lock:
+                _myfitnesspal_clients[key] = client
+    return client
+
+
+def close_myfitnesspal_clients() -> None:
+    """
+    Close the HTTP sessions of all shared myfitnesspal clients.
+    """
+    with _myfitnesspal_clients_lock:
+        while _myfitnesspal_clients:
+            _, client = _myfitnesspal_clients.popitem()
+            session = getattr(client, "session", None)
+            if session is not None:
+                session.close()
+
+
+def get_dropbox_client(token: str) -> "dropbox.Dropbox":
+    """
+    Return a Dropbox client shared by all backup tasks using the provided token.
+
+    The client keeps its HTTP session, so the backup upload, listing and rotation
+    reuse the same connection to Dropbox instead of opening one each.
+
+    Args:
+       - token (str): The Dropbox access token
+
+    Returns:
+       - dropbox.Dropbox: The client for the provided token
+    """
+    # imported on first use, so the ETL and report flows never load the dropbox SDK
+    import dropbox
+
+    with _dropbox_clients_lock:
+        client = _dropbox_clients.get(token)
+        if client is None:
+            client = dropbox.Dropbox(token)
+            _dropbox_clients[token] = client
+    return client
+
+
+def close_dropbox_clients() -> None:
+    """
+    Close all shared Dropbox clients opened by `get_dropbox_client`.
+    """
+    with _dropbox_clients_lock:
+        while _dropbox_clients:
+            _, client = _dropbox_clients.popitem()
+            client.close()
+
+
 class MyfitnesspalClientAdapter:
     """
     An adapter class to handle the external myfitnesspal dependency.
@@ -88,7 +427,14 @@ class MyfitnesspalClientAdapter:
             raise ValueError("Username and password arguments must be provided.")
         self._username = username
         self._password = password
-        self._client = myfitnesspal.Client(self._username, self._password)
+        self._client = None
+
+    @property
+    def client(self):
+        # logging in is deferred until the first request that needs the client
+        if self._client is None:
+            self._client = get_myfitnesspal_client(self._username, self._password)
+        return self._client
 
     def __enter__(self):
         return self
@@ -96,24 +442,43 @@ class MyfitnesspalClientAdapter:
     def __exit__(self, err_type, err_value, err_traceback):
         self.close()
 
-    def _get_measurements(self, date, measures):
-        measurements = {}
-        for measure in measures:
-            try:
-                response = self._client.get_measurements(measure, date, date)
-                measurement_value = response.get(date, None)
-                if measurement_value:
-                    measurements[measure] = measurement_value
-            except ValueError:
-                print(f"No measure records found for {measure} measure.")
-        return measurements
+    def _get_measure(self, measure, from_date, to_date):
+        try:
+            response = self.client.get_measurements(measure, from_date, to_date)
+        except ValueError:
+            # myfitnesspal has no records for the measure
+            return None
+        return dict(response)
+
+    def get_measurements(self, from_date, to_date, measures):
+        if not measures:
+            return {}
+        # each measure is a separate request, so they are fetched concurrently
+        with ThreadPoolExecutor(max_workers=len(measures)) as executor:
+            responses = executor.map(
+                lambda measure: self._get_measure(measure, from_date, to_date),
+                measures,
+            )
+            measurements = dict(zip(measures, responses))
+        missing = [m for m, values in measurements.items() if values is None]
+        if missing:
+            logger.info("No measure records found for: %s", ", ".join(missing))
+        return {
+            measure: values
+            for measure, values in measurements.items()
+            if values is not None
+        }
 
     def _get_date(self, date):
-        return self._client.get_date(date)
+        return self.client.get_date(date)
 
-    def get_myfitnesspaw_day(self, date, measures):
+    def get_myfitnesspaw_day(self, date, measurements):
         day = self._get_date(date)
-        measurements = self._get_measurements(date, measures)
+        day_measurements = {}
+        for measure, values in measurements.items():
+            measurement_value = values.get(date, None)
+            if measurement_value:
+                day_measurements[measure] = measurement_value
         return MaterializedDay(
             username=self._username,
             date=date,
@@ -122,8 +487,9 @@ class MyfitnesspalClientAdapter:
             goals=day.goals,
             notes=day.notes.as_dict(),
             water=day.water,
-            measurements=measurements,
+            measurements=day_measurements,
         )
 
     def close(self):
+        # the client is shared, its session is closed by close_myfitnesspal_clients
         self._client = None
@@ -19,6 +19,14 @@ import prefect
 
 from . import _utils, flows
 
+_ETL_PARAMETERS = ("from_date", "to_date", "measures")
+
+
+def _configure(flow: "prefect.Flow") -> "prefect.Flow":
+    """Attach the local run configuration to the provided flow and return it."""
+    flow.run_config = _utils.get_local_run_config()
+    return flow
+
 
 def run_etl_flow(
     username: str = None, **kwargs
@@ -41,22 +49,15 @@ def run_etl_flow(
        - ValueError: if the `username` keyword argument is not provided
     """
 
-    flow = flows.get_etl_flow(username=username)
+    flow = _configure(flows.get_etl_flow(username=username))
     # prepare parameters to pass at runtime
-    parameters = {}
-    if kwargs.get("from_date"):
-        parameters["from_date"] = kwargs.get("from_date")
-    if kwargs.get("to_date"):
-        parameters["to_date"] = kwargs.get("to_date")
-    if kwargs.get("measures"):
-        parameters["measures"] = kwargs.get("measures")
-    flow.run_config = _utils.get_local_run_config()
+    parameters = {key: value for key in _ETL_PARAMETERS if (value := kwargs.get(key))}
 
     return flow.run(parameters=parameters)
 
 
 def run_report_flow(
-    username: str = None, parameters: dict = {}
+    username: str = None, parameters: dict = None
 ) -> Union["prefect.engine.state.State", None]:
     """
     Create a report flow for the provided user and execute it locally.
@@ -71,10 +72,9 @@ def run_report_flow(
     Raises:
        - ValueError: if the `username` keyword argument is not provided
     """
-    flow = flows.get_report_flow(username=username)
-    flow.run_config = _utils.get_local_run_config()
+    flow = _configure(flows.get_report_flow(username=username))
 
-    return flow.run(parameters=parameters)
+    return flow.run(parameters=parameters if parameters is not None else {})
 
 
 def run_backup_flow() -> Union["prefect.engine.state.State", None]:
@@ -84,8 +84,7 @@ def run_backup_flow() -> Union["prefect.engine.state.State", None]:
     Returns:
        - State: the state of the flow after the completed run.
     """
-    flow = flows.get_backup_flow()
-    flow.run_config = _utils.get_local_run_config()
+    flow = _configure(flows.get_backup_flow())
 
     return flow.run()
 
@@ -112,8 +111,7 @@ def register_etl_flow(
        - ValueError: if the `project_name` keyword argument is not provided
     """
 
-    flow = flows.get_etl_flow(username=username, flow_name=flow_name)
-    flow.run_config = _utils.get_local_run_config()
+    flow = _configure(flows.get_etl_flow(username=username, flow_name=flow_name))
 
     return flow.register(project_name=project_name)
 
@@ -141,10 +139,7 @@ def register_report_flow(
        - ValueError: if the `username` keyword argument is not provided
        - ValueError: if the `project_name` keyword argument is not provided
     """
-    flow = flows.get_report_flow(
-        username=username, flow_name=flow_name
-    )
-    flow.run_config = _utils.get_local_run_config()
+    flow = _configure(flows.get_report_flow(username=username, flow_name=flow_name))
 
     return flow.register(project_name=project_name)
 
@@ -168,6 +163,5 @@ def register_backup_flow(
     Raises:
        - ValueError: if the `project_name` keyword argument is not provided
     """
-    flow = flows.get_backup_flow(flow_name=flow_name)
-    flow.run_config = _utils.get_local_run_config()
+    flow = _configure(flows.get_backup_flow(flow_name=flow_name))
     return flow.register(project_name=project_name)
@@ -9,9 +9,31 @@ import datetime
 import prefect
 from prefect import Flow, unmapped
 from prefect.core import Parameter
+from prefect.executors import LocalDaskExecutor
 from prefect.tasks.secrets import PrefectSecret
 
-from . import DB_PATH, sql, tasks
+from . import _utils, sql, tasks
+
+
+def _close_sqlite_connections(flow: Flow, old_state, new_state):
+    """Flow state handler releasing the shared sqlite connections once finished."""
+    if new_state.is_finished():
+        _utils.close_sqlite_connections()
+    return new_state
+
+
+def _close_myfitnesspal_clients(flow: Flow, old_state, new_state):
+    """Flow state handler releasing the shared myfitnesspal sessions once finished."""
+    if new_state.is_finished():
+        _utils.close_myfitnesspal_clients()
+    return new_state
+
+
+def _close_dropbox_clients(flow: Flow, old_state, new_state):
+    """Flow state handler releasing the shared Dropbox clients once finished."""
+    if new_state.is_finished():
+        _utils.close_dropbox_clients()
+    return new_state
 
 
 def get_etl_flow(
@@ -35,9 +57,16 @@ def get_etl_flow(
     if not username:
         raise ValueError("An user must be provided for the flow")
 
-    mfp_insertmany = tasks.SQLiteExecuteMany(db=DB_PATH, enforce_fk=True)
     flow_name = flow_name or f"MyFitnessPaw ETL <{username.upper()}>"
-    with Flow(name=flow_name) as etl_flow:
+    # days are scraped by mapped network bound tasks, so they are fetched in parallel
+    # the extraction tasks have no prefect timeout, which would move every run off the
+    # threads into a new process with its own login; their requests time out instead
+    executor = LocalDaskExecutor(scheduler="threads", num_workers=8)
+    with Flow(
+        name=flow_name,
+        executor=executor,
+        state_handlers=[_close_sqlite_connections, _close_myfitnesspal_clients],
+    ) as etl_flow:
         from_date, to_date = tasks.prepare_extraction_start_end_dates(
             from_date_str=Parameter(name="from_date", default=None),
             to_date_str=Parameter(name="to_date", default=None),
@@ -45,81 +74,44 @@ def get_etl_flow(
         measures = Parameter(name="measures", default=["Weight"])
         usermail = PrefectSecret(f"MYFITNESSPAL_USERNAME_{username.upper()}")
         password = PrefectSecret(f"MYFITNESSPAL_PASSWORD_{username.upper()}")
-        db_exists = tasks.create_mfp_database()
         dates_to_extract = tasks.generate_dates_to_extract(from_date, to_date)
-        extracted_days = tasks.get_myfitnesspal_day.map(
+        measurements = tasks.get_myfitnesspal_measurements(
+            username=usermail,
+            password=password,
+            from_date=from_date,
+            to_date=to_date,
+            measures=measures,
+        )
+        fetched_days = tasks.get_myfitnesspal_day.map(
             date=dates_to_extract,
             username=unmapped(usermail),
             password=unmapped(password),
-            measures=unmapped(measures),
+            measurements=unmapped(measurements),
         )
+        extracted_days = tasks.collect_extracted_days(fetched_days)
         serialized_extracted_days = tasks.serialize_myfitnesspal_days(extracted_days)
-        mfp_existing_days = tasks.mfp_select_raw_days(
-            username=usermail,
-            dates=dates_to_extract,
-            upstream_tasks=[db_exists],
-        )
-        serialized_days_to_process = tasks.filter_new_or_changed_records(
-            extracted_records=serialized_extracted_days,
-            local_records=mfp_existing_days,
-        )
-        rawdays_load_state = mfp_insertmany(
-            query=sql.insert_or_replace_rawdaydata_record,
-            data=serialized_days_to_process,
-        )
-
-        days_to_process = tasks.deserialize_records_to_process(
-            serialized_days=serialized_days_to_process,
-            upstream_tasks=[rawdays_load_state],
-        )
-        note_records = tasks.extract_notes(days_to_process)
-        notes_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_notes,
-            data=note_records,
-        )
-
-        water_records = tasks.extract_water(days_to_process)
-        water_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_water,
-            data=water_records,
-        )
-
-        goal_records = tasks.extract_goals(days_to_process)
-        goals_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_goals,
-            data=goal_records,
-        )
-        meals_to_process = tasks.extract_meals(days_to_process)
-        meal_records = tasks.extract_meal_records(meals_to_process)
-        meals_load_state = mfp_insertmany(
-            query=sql.insert_meals,
-            data=meal_records,
-        )
-
-        mealentry_records = tasks.extract_mealentries(meals_to_process)
-        mealentries_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_mealentries,
-            data=mealentry_records,
-            upstream_tasks=[meals_load_state],
-        )
-
-        cardio_records = tasks.extract_cardio_exercises(days_to_process)
-        cardio_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_cardioexercises,
-            data=cardio_records,
-        )
-
-        strength_records = tasks.extract_strength_exercises(days_to_process)
-        strength_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_strengthexercises,
-            data=strength_records,
-        )
-
-        measurements_records = tasks.extract_measures(days_to_process)
-        measurements_load_state = mfp_insertmany(  # noqa
-            query=sql.insert_measurements,
-            data=measurements_records,
-        )
+        note_records = tasks.extract_notes(extracted_days)
+        water_records = tasks.extract_water(extracted_days)
+        goal_records = tasks.extract_goals(extracted_days)
+        day_records = tasks.extract_day_records(extracted_days)
+        measurements_records = tasks.extract_measures(extracted_days)
+
+        load_state = tasks.mfp_load_all(
+            raw_day_records=serialized_extracted_days,
+            payloads={
+                sql.insert_notes: note_records,
+                sql.insert_water: water_records,
+                sql.insert_goals: goal_records,
+                sql.insert_meals: day_records["meals"],
+                sql.insert_mealentries: day_records["mealentries"],
+                sql.insert_cardioexercises: day_records["cardio_exercises"],
+                sql.insert_strengthexercises: day_records["strength_exercises"],
+                sql.insert_measurements: measurements_records,
+            },
+        )
+    # the days that were extracted are loaded, but failed extractions fail the run; the
+    # days are not loaded without their measurements, which would replace stored ones
+    etl_flow.set_reference_tasks([measurements, fetched_days, load_state])
 
     return etl_flow
 
@@ -143,7 +135,9 @@ def get_report_flow(username: str = None, flow_name: str = None) -> Flow:
 
     flow_name = flow_name or f"MyFitnessPaw Progress Report <{username.upper()}>"
 
-    with Flow(name=flow_name) as progress_report_flow:
+    with Flow(
+        name=flow_name, state_handlers=[_close_sqlite_connections]
+    ) as progress_report_flow:
         usermail = PrefectSecret(f"MYFITNESSPAL_USERNAME_{username.upper()}")
         starting_date = Parameter(
             name="starting_date",
@@ -177,13 +171,13 @@ def get_backup_flow(flow_name: str = None) -> Flow:
 
     flow_name = flow_name or "MyFitnessPaw DB Backup"
 
-    with Flow(flow_name) as backup_flow:
+    with Flow(flow_name, state_handlers=[_close_dropbox_clients]) as backup_flow:
         dbx_mfp_dir = prefect.config.myfitnesspaw.backup.dbx_backup_dir
         dbx_token = PrefectSecret("MYFITNESSPAW_DROPBOX_ACCESS_TOKEN")
-        backup_result = tasks.make_dropbox_backup(dbx_token, dbx_mfp_dir)  # noqa
-        avail_backups = tasks.dbx_list_available_backups(dbx_token, dbx_mfp_dir)
+        backup_result = tasks.make_dropbox_backup(dbx_token, dbx_mfp_dir)
+        # old backups are only rotated out once the new one is uploaded
         res = tasks.apply_backup_rotation_scheme(  # noqa
-            dbx_token, dbx_mfp_dir, avail_backups
+            dbx_token, dbx_mfp_dir, upstream_tasks=[backup_result]
         )
 
     return backup_flow
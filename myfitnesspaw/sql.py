@@ -8,11 +8,16 @@ create_raw_day_table = """
 CREATE TABLE IF NOT EXISTS RawDayData (
   userid text NOT NULL,
   date text NOT NULL,
-  rawdaydata json,
+  rawdaydata BLOB,
+  rawdaydata_hash BLOB,
   PRIMARY KEY(userid, date)
 );
 """
 
+add_rawdaydata_hash_column = """
+ALTER TABLE RawDayData ADD COLUMN rawdaydata_hash BLOB;
+"""
+
 create_meals_table = """
 CREATE TABLE IF NOT EXISTS Meals (
   userid text NOT NULL,
@@ -144,13 +149,59 @@ CREATE TABLE IF NOT EXISTS Measurements (
 );
 """
 
-select_rawdaydata_record = """
-SELECT rawdaydata FROM RawDayData WHERE userid=? AND date=?
+create_mealentries_index = """
+CREATE INDEX IF NOT EXISTS idx_mealentries_meal
+ON MealEntries(userid, date, meal_name);
+"""
+
+create_cardioexercises_index = """
+CREATE INDEX IF NOT EXISTS idx_cardioexercises_day
+ON CardioExercises(userid, date);
+"""
+
+create_strengthexercises_index = """
+CREATE INDEX IF NOT EXISTS idx_strengthexercises_day
+ON StrengthExercises(userid, date);
+"""
+
+# child table indexes which can be dropped during large loads and rebuilt afterwards
+deferrable_indexes = {
+    "idx_mealentries_meal": create_mealentries_index,
+    "idx_cardioexercises_day": create_cardioexercises_index,
+    "idx_strengthexercises_day": create_strengthexercises_index,
+}
+
+# bump whenever create_mfp_database changes, so existing databases get upgraded
+schema_version = 1
+
+create_mfp_database = "".join(
+    (
+        create_raw_day_table,
+        create_notes_table,
+        create_water_table,
+        create_goals_table,
+        create_meals_table,
+        create_mealentries_table,
+        create_cardioexercises_table,
+        create_strengthexercises_table,
+        create_measurements_table,
+        create_mealentries_index,
+        create_cardioexercises_index,
+        create_strengthexercises_index,
+    )
+)
+
+count_rawdaydata_records = """
+SELECT count(*) FROM RawDayData
 """
 
-insert_or_replace_rawdaydata_record = """
-INSERT OR REPLACE INTO RawDayData(userid, date, rawdaydata)
-VALUES (?, ?, ?)
+insert_or_replace_changed_rawdaydata_record = """
+INSERT OR REPLACE INTO RawDayData(userid, date, rawdaydata, rawdaydata_hash)
+SELECT ?1, ?2, ?3, ?4
+WHERE NOT EXISTS (
+  SELECT 1 FROM RawDayData
+  WHERE userid = ?1 AND date = ?2 AND rawdaydata_hash = ?4
+)
 """
 
 insert_notes = """
@@ -5,36 +5,71 @@ Contains all tasks used in this project's flows.
 """
 
 import datetime
+import gzip
+import hashlib
 import os
+import pickle
+import shutil
 import smtplib
 import sqlite3
 import ssl
+import tempfile
+import time
+import zlib
 from contextlib import closing
 from datetime import timedelta
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Any, List, Tuple, Union, cast
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, Dict, List, Tuple, Union, cast
 
-import dropbox
 import jinja2
-import jsonpickle
 import prefect
-from dropbox.files import WriteMode
-from myfitnesspal.meal import Meal
 from prefect import Task, task
 from prefect.client import Secret
+from prefect.engine import signals
+from prefect.triggers import all_finished
 from prefect.utilities.tasks import defaults_from_attrs
 
 from . import DB_PATH, TEMPLATES_DIR, sql
 from ._utils import (
     MyfitnesspalClientAdapter,
+    batched,
+    executemany_multirow,
+    get_dropbox_client,
+    get_mfp_database_connection,
+    get_sqlite_connection,
     select_fifo_backups_to_delete,
+    sqlite_transaction,
     try_parse_date_str,
 )
 from .types import MaterializedDay, ProgressReport, User
 
+if TYPE_CHECKING:
+    import dropbox
+
+# myfitnesspal totals keys, in the order of the nutrient columns in the database
+_NUTRIENT_KEYS = ("calories", "carbohydrates", "fat", "protein", "sodium", "sugar")
+# myfitnesspal exercise keys, in the order of the exercise columns in the database
+_CARDIO_KEYS = ("minutes", "calories burned")
+_STRENGTH_KEYS = ("sets", "reps/set", "weight/set")
+# rows per executemany call when loading records
+_LOAD_CHUNK_SIZE = 10_000
+# share of the stored days that must change for the child indexes to be rebuilt after
+# the load instead of updated; rebuilding covers the whole tables, so it only pays off
+# for the initial backfill or similarly large loads
+_DEFER_INDEXES_MIN_FRACTION = 0.5
+# seconds to wait between status checks of an asynchronous dropbox batch delete
+_DBX_BATCH_POLL_INTERVAL = 0.5
+# status checks after which a dropbox batch delete still in progress fails the task
+_DBX_BATCH_MAX_POLLS = 120
+# the database is uploaded in chunks of this size instead of being read whole
+_DBX_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# the database pages compress well, so backups are uploaded gzipped
+_BACKUP_COMPRESS_LEVEL = 6
+
 
 class SQLiteExecuteMany(Task):
     """
@@ -44,6 +79,9 @@ class SQLiteExecuteMany(Task):
       - `commit` parameter is not implemented. Transaction is executed immediately.
     TODO: Fix that.
 
+    The task runs on the connection shared for the database file (see
+    `_utils.get_sqlite_connection`) and wraps the statements in a single transaction.
+
     Args:
       - db (str, optional): the location of the database file
       - query (str, optional): the optional _default_ query to execute at runtime;
@@ -51,11 +89,11 @@ class SQLiteExecuteMany(Task):
         default
       - data ([Tuple]): list of values to be used with the query
       - enforce_fk (bool, optional): SQLite does not enforce foreign key constraints by
-        default (see https://sqlite.org/foreignkeys.html). In order to enable foreign key
-        support, an additional `PRAGMA foreign_keys = YES;` statement is executed before
-        the main task statement. TODO: There is an additional case where the sqlite
-        database has been compiled without FK support which is not yet handled by this
-        task
+        default (see https://sqlite.org/foreignkeys.html). The shared connection enables
+        them when opened; unless this is True, a `PRAGMA foreign_keys = NO;` statement
+        is executed before the main task statement and the setting is restored after it.
+        TODO: There is an additional case where the sqlite database has been compiled
+        without FK support which is not yet handled by this task
       - **kwargs (optional): additional keyword arguments to pass to the standard
         Task initialization
 
@@ -121,11 +159,17 @@ class SQLiteExecuteMany(Task):
 
         db = cast(str, db)
         query = cast(str, query)
-        with closing(sqlite3.connect(db)) as conn, closing(conn.cursor()) as cursor:
-            if enforce_fk:
-                cursor.execute("PRAGMA foreign_keys = YES;")
-            cursor.executemany(query, data)
-            conn.commit()
+        conn = get_sqlite_connection(db)
+        if not enforce_fk:
+            conn.execute("PRAGMA foreign_keys = NO;")
+        try:
+            with sqlite_transaction(conn):
+                for chunk in batched(data, _LOAD_CHUNK_SIZE):
+                    conn.executemany(query, chunk)
+        finally:
+            # the connection is shared, so the default must be restored
+            if not enforce_fk:
+                conn.execute("PRAGMA foreign_keys = YES;")
 
 
 class LiskoEmail(Task):
@@ -233,7 +277,7 @@ class LiskoEmail(Task):
             server.quit()
 
 
-@task
+@task(checkpoint=False)
 def prepare_extraction_start_end_dates(
     from_date_str: Union[str, None], to_date_str: Union[str, None]
 ) -> Tuple[datetime.date, datetime.date]:
@@ -280,7 +324,7 @@ def prepare_extraction_start_end_dates(
     return from_date, to_date
 
 
-@task
+@task(checkpoint=False)
 def generate_dates_to_extract(
     from_date: datetime.date, to_date: datetime.date
 ) -> List[datetime.date]:
@@ -307,128 +351,134 @@ def generate_dates_to_extract(
     return [from_date + timedelta(days=i) for i in range(delta_days + 1)]
 
 
-@task
-def create_mfp_database() -> None:
+@task(max_retries=5, retry_delay=timedelta(seconds=15))
+def get_myfitnesspal_measurements(
+    username: str,
+    password: str,
+    from_date: datetime.date,
+    to_date: datetime.date,
+    measures: List[str],
+) -> Dict[str, Dict[datetime.date, float]]:
     """
-    Create the MyFitnessPaw project sqlite database schema.
+    Get the myfitnesspal measurements for a range of dates.
 
-    This task executes a series of commands to build the project database tables.
-    All tables are created using the CREATE TABLE IF NOT EXISTS clause, making this
-    function safe to run against an already existing database, thus making the
-    task idempotent.
+    Each measure is requested once for the whole range, instead of once for every date.
+
+    Args:
+       - username (str): The username for the myfitnesspal account
+       - password (str): The password associated with the provided username
+       - from_date (datetime.date): The first date of the range
+       - to_date (datetime.date): The last date of the range
+       - measures (List[str]): A list of measures to be collected
 
     Returns:
-        - None
+       - Dict[str, Dict[datetime.date, float]]: The measurement values by date for each
+         measure found
     """
-    create_mfp_db_script = f"""
-    {sql.create_raw_day_table}
-    {sql.create_notes_table}
-    {sql.create_water_table}
-    {sql.create_goals_table}
-    {sql.create_meals_table}
-    {sql.create_mealentries_table}
-    {sql.create_cardioexercises_table}
-    {sql.create_strengthexercises_table}
-    {sql.create_measurements_table}
-    """
-    with closing(sqlite3.connect(DB_PATH)) as conn, closing(conn.cursor()) as c:
-        c.executescript(create_mfp_db_script)
-        conn.commit()
 
+    with MyfitnesspalClientAdapter(username, password) as myfitnesspal:
+        measurements = myfitnesspal.get_measurements(from_date, to_date, measures)
 
-@task(timeout=15, max_retries=5, retry_delay=timedelta(seconds=15))
+    return measurements
+
+
+@task(max_retries=5, retry_delay=timedelta(seconds=15))
 def get_myfitnesspal_day(
-    username: str, password: str, date: datetime.date, measures: List[str]
+    username: str,
+    password: str,
+    date: datetime.date,
+    measurements: Dict[str, Dict[datetime.date, float]],
 ) -> MaterializedDay:
     """
     Get the myfitnesspal data associated with the given date.
 
-    Extracts the myfitnesspal data for a date, which includes all food, exercise, notes,
-    water, and also the measurements for the provided measures list for the given date.
+    Extracts the myfitnesspal data for a date, which includes all food, exercise, notes
+    and water, and picks the values for the date from the provided measurements.
+
+    The task has no prefect timeout: on the threaded executor a timeout runs the task
+    in a new process, which logs in again instead of using the shared client. Each
+    request of the client times out instead, so a day fetch only stalls when the
+    server keeps sending data slowly; such a fetch holds one executor thread until it
+    completes.
 
     Args:
        - username (str): The username for the myfitnesspal account
        - password (str): The password associated with the provided username
        - date (datetime.date): The date to extract data for
-       - measures (List[str]): A list of measures to be collected
+       - measurements (Dict[str, Dict[datetime.date, float]]): The measurement values
+         by date for each measure to be collected
 
     Returns:
        - MaterializedDay: Containing the extracted information
     """
 
     with MyfitnesspalClientAdapter(username, password) as myfitnesspal:
-        day = myfitnesspal.get_myfitnesspaw_day(date, measures)
+        day = myfitnesspal.get_myfitnesspaw_day(date, measurements)
 
     return day
 
 
-@task
-def serialize_myfitnesspal_days(
-    myfitnesspal_days: List[MaterializedDay],
-) -> List[Tuple[str, datetime.date, str]]:
+@task(checkpoint=False, trigger=all_finished)
+def collect_extracted_days(fetched_days: List[Any]) -> List[MaterializedDay]:
     """
-    Prepare a list of serialized day records.
+    Collect the successfully extracted days, dropping the failed extractions.
+
+    The task runs even when some of the upstream extractions have failed, so one date
+    exhausting its retries does not prevent the rest of the days from being loaded.
+    The flow still fails on the failed extractions (they are among its reference
+    tasks), and the failed dates are picked up again by the next run.
 
     Args:
-      - myfitnesspal_days (List[MaterializedDay]): A list of day objects to be serialized
+      - fetched_days (List[Any]): The results of the day extractions, which are either
+        days or the errors of the failed extractions
 
     Returns:
-      - List[Tuple[str, datetime.date, str]]: A list of serialized day objects
-    """
-    return [
-        (day.username, day.date, jsonpickle.encode(day)) for day in myfitnesspal_days
-    ]
+      - List[MaterializedDay]: A list with the successfully extracted days
 
-
-@task
-def filter_new_or_changed_records(
-    extracted_records: List[str], local_records: List[str]
-) -> List[str]:
+    Raises:
+      - signals.FAIL: if the upstream extraction did not produce a list of results
     """
-    Filter out extracted records that are available and unchanged.
-
-    Any information that had been changed in myfitnesspal will produce a mismatch when
-    compared against the available copy. All other records that are locally available
-    are discarded from the list.
 
-    Args:
-      - extracted_records (List[str]): The list with the newly extracted records
-      - local_records (List[str]): The list with the locally available records
-
-    Returns:
-      - List[str]: A list with new or changed day objects
-    """
+    if not isinstance(fetched_days, list):
+        # the mapping itself failed, so there are no extractions to collect
+        if isinstance(fetched_days, Exception):
+            raise fetched_days
+        raise signals.FAIL("The day extraction failed upstream.")
     logger = prefect.context.get("logger")
-    records_to_upsert = [t for t in extracted_records if t not in local_records]
-    logger.info(f"Records to Insert/Update: {len(records_to_upsert)}")
+    days = [day for day in fetched_days if isinstance(day, MaterializedDay)]
+    if len(days) < len(fetched_days):
+        logger.warning(f"Days failed to extract: {len(fetched_days) - len(days)}")
 
-    return records_to_upsert
+    return days
 
 
-@task
-def deserialize_records_to_process(
-    serialized_days: List[str],
-) -> List[MaterializedDay]:
+@task(checkpoint=False)
+def serialize_myfitnesspal_days(
+    myfitnesspal_days: List[MaterializedDay],
+) -> List[Tuple[str, datetime.date, bytes, bytes]]:
     """
-    Deserialize a sequence of days.
+    Prepare a list of serialized day records.
+
+    The days are pickled and stored zlib compressed. Each record carries a digest of the
+    pickled day, which is what gets compared against the stored copy to detect changed
+    days.
 
     Args:
-      - serialized_days (List[str]): A list containing the serialized days to be
-        converted back to `MaterializedDay` objects
+      - myfitnesspal_days (List[MaterializedDay]): A list of day objects to be serialized
 
     Returns:
-      - List[MaterializedDay]: A list with deserialized day objects
+      - List[Tuple[str, datetime.date, bytes, bytes]]: A list of compressed pickled day
+        objects with their digests
     """
+    records = []
+    for day in myfitnesspal_days:
+        day_blob = pickle.dumps(day, protocol=pickle.HIGHEST_PROTOCOL)
+        day_hash = hashlib.blake2b(day_blob, digest_size=16).digest()
+        records.append((day.username, day.date, zlib.compress(day_blob, 1), day_hash))
+    return records
 
-    result = []
-    for day_json in serialized_days:
-        day_decoded = jsonpickle.decode(day_json[2], classes=[MaterializedDay])
-        result.append(day_decoded)
-
-    return result
 
-
-@task
+@task(checkpoint=False)
 def extract_notes(days: List[MaterializedDay]) -> List[Tuple]:
     """
     Extract myfitnesspal food note values from a list of myfitnesspal days.
@@ -452,7 +502,7 @@ def extract_notes(days: List[MaterializedDay]) -> List[Tuple]:
     ]
 
 
-@task
+@task(checkpoint=False)
 def extract_water(days: List[MaterializedDay]) -> List[Tuple]:
     """
     Extract myfitnesspal water values from a list of myfitnesspal days.
@@ -467,7 +517,7 @@ def extract_water(days: List[MaterializedDay]) -> List[Tuple]:
     return [(day.username, day.date, day.water) for day in days]
 
 
-@task
+@task(checkpoint=False)
 def extract_goals(days: List[MaterializedDay]) -> List[Tuple]:
     """
     Extract myfitnesspal daily goals from a sequence of myfitnesspal days.
@@ -480,156 +530,79 @@ def extract_goals(days: List[MaterializedDay]) -> List[Tuple]:
     """
 
     return [
-        (
-            day.username,
-            day.date,
-            day.goals.get("calories", None),
-            day.goals.get("carbohydrates", None),
-            day.goals.get("fat", None),
-            day.goals.get("protein", None),
-            day.goals.get("sodium", None),
-            day.goals.get("sugar", None),
-        )
-        for day in days
+        (day.username, day.date, *map(day.goals.get, _NUTRIENT_KEYS)) for day in days
     ]
 
 
-@task
-def extract_meals(days: List[MaterializedDay]) -> List[Meal]:
+@task(checkpoint=False)
+def extract_day_records(days: List[MaterializedDay]) -> Dict[str, List[Tuple]]:
     """
-    Extract myfitnesspal neal items from a sequence of myfitnesspal days.
+    Extract meal, meal entry and exercise records from a sequence of myfitnesspal days.
+
+    All record types are collected in a single pass over the days.
 
     Args:
       - days (List[MaterializedDay]): A list containing the days to extract data from
 
     Returns:
-      - List[Meal]: A list with meal record values
+      - Dict[str, List[Tuple]]: The record values keyed by record type: `meals`,
+        `mealentries`, `cardio_exercises` and `strength_exercises`
     """
 
+    meal_records: List[Tuple] = []
+    mealentry_records: List[Tuple] = []
+    cardio_records: List[Tuple] = []
+    strength_records: List[Tuple] = []
     for day in days:
+        username, date = day.username, day.date
         for meal in day.meals:
-            if not meal:  # TODO: ?
+            if not meal:  # empty meals have no records
                 continue
-            meal.username = day.username
-            meal.date = day.date
-
-    return [meal for day in days for meal in day.meals if meal]
-
-
-@task
-def extract_meal_records(meals: List[Meal]) -> List[Tuple]:
-    """
-    Extract meal entry records from a sequence of myfitnesspal meals.
-
-    Args:
-      - meals (List[Meal]): A list with meal objects to extract data from
-
-    Returns:
-      - List[Tuple]: A list with meal record values
-    """
-
-    return [
-        (
-            meal.username,
-            meal.date,
-            meal.name,
-            meal.totals.get("calories", None),
-            meal.totals.get("carbohydrates", None),
-            meal.totals.get("fat", None),
-            meal.totals.get("protein", None),
-            meal.totals.get("sodium", None),
-            meal.totals.get("sugar", None),
-        )
-        for meal in meals
-    ]
-
-
-@task
-def extract_mealentries(meals: List[Meal]) -> List[Tuple]:
-    """
-    Extract meal entries records from a sequence of myfitnesspal meals.
-
-    Args:
-      - meals (List[Meal]): A list with meal objects to extract data from
-
-    Returns:
-      - List[Tuple]: A list with meal record values
-    """
-
-    return [
-        (
-            meal.username,
-            meal.date,
-            meal.name,
-            entry.short_name,
-            entry.quantity,
-            entry.unit,
-            entry.totals.get("calories", None),
-            entry.totals.get("carbohydrates", None),
-            entry.totals.get("fat", None),
-            entry.totals.get("protein", None),
-            entry.totals.get("sodium", None),
-            entry.totals.get("sugar", None),
+            meal_name = meal.name
+            meal_records.append(
+                (username, date, meal_name, *map(meal.totals.get, _NUTRIENT_KEYS))
+            )
+            mealentry_records.extend(
+                (
+                    username,
+                    date,
+                    meal_name,
+                    entry.short_name,
+                    entry.quantity,
+                    entry.unit,
+                    *map(entry.totals.get, _NUTRIENT_KEYS),
+                )
+                for entry in meal.entries
+            )
+        cardio_exercises, strength_exercises = day.exercises[0], day.exercises[1]
+        cardio_records.extend(
+            (
+                username,
+                date,
+                record.name,
+                *map(record.nutrition_information.get, _CARDIO_KEYS),
+            )
+            for record in cardio_exercises
         )
-        for meal in meals
-        for entry in meal.entries
-    ]
-
-
-@task
-def extract_cardio_exercises(days: List[MaterializedDay]) -> List[Tuple]:
-    """
-    Extract cardio exercise entries from a sequence of myfitnesspal days.
-
-    Args:
-      - days (List[MaterializedDay]): A list containing the days to extract data from
-
-    Returns:
-      - List[Tuple]: A list with cardio exercise record values
-    """
-
-    return [
-        (
-            day.username,
-            day.date,
-            record.name,
-            record.nutrition_information.get("minutes", None),
-            record.nutrition_information.get("calories burned", None),
+        strength_records.extend(
+            (
+                username,
+                date,
+                record.name,
+                *map(record.nutrition_information.get, _STRENGTH_KEYS),
+            )
+            for record in strength_exercises
         )
-        for day in days
-        for record in day.exercises[0]
-    ]
 
-
-@task
-def extract_strength_exercises(
-    days: List[MaterializedDay],
-) -> List[Tuple]:
-    """
-    Extract strength exercise entries from a sequence of myfitnesspal days.
-
-    Args:
-      - days (List[MaterializedDay]): A list containing the days to extract data from
-
-    Returns:
-      - List[Tuple]: A list with strength exercise record values
-    """
-
-    return [
-        (
-            day.username,
-            day.date,
-            record.name,
-            record.nutrition_information.get("sets", None),
-            record.nutrition_information.get("reps/set", None),
-            record.nutrition_information.get("weight/set", None),
-        )
-        for day in days
-        for record in day.exercises[1]
-    ]
+    return {
+        "meals": meal_records,
+        "mealentries": mealentry_records,
+        "cardio_exercises": cardio_records,
+        "strength_exercises": strength_records,
+    }
 
 
-@task
+@task(checkpoint=False)
 def extract_measures(days: List[MaterializedDay]) -> List[Tuple]:
     """
     Extract measures values from a sequence of myfitnesspal days.
@@ -654,30 +627,59 @@ def extract_measures(days: List[MaterializedDay]) -> List[Tuple]:
 
 
 @task
-def mfp_select_raw_days(
-    username: str, dates: List[datetime.date]
-) -> List[Tuple[str, datetime.date, str]]:
+def mfp_load_all(
+    raw_day_records: List[Tuple[str, datetime.date, bytes, bytes]],
+    payloads: Dict[str, List[Tuple]],
+) -> int:
     """
-    Select raw day entries for username and provided dates.
+    Load the new or changed days and their records into the database.
+
+    A raw day is only written when no stored copy with the same digest exists, which
+    leaves SQLite to decide what changed. Replacing a changed day cascade deletes its
+    stale records, and the records in `payloads` are then loaded for the written days
+    only. Everything runs in a single transaction. When a large share of the stored days
+    changes (e.g. the initial backfill) the child table indexes are dropped while the
+    records are inserted and rebuilt once at the end.
+
+    The queries are executed in the order provided, so records referenced by foreign
+    keys must come before the records referencing them.
 
     Args:
-      - username (str): The username to select
-      - dates (List[datetime.date]): A list with dates to select
+      - raw_day_records (List[Tuple]): The serialized day records with their digests
+      - payloads (Dict[str, List[Tuple]]): The insert queries mapped to the list of
+        records to execute them with, each record starting with username and date
 
     Returns:
-      - List[Tuple]: A list containing the serialized days selected
+      - int: The number of new or changed days loaded
     """
 
-    mfp_existing_days = []
-    with closing(sqlite3.connect(DB_PATH)) as conn, closing(conn.cursor()) as c:
-        c.execute("PRAGMA foreign_keys = YES;")
-        for date in dates:
-            c.execute(sql.select_rawdaydata_record, (username, date))
-            result = c.fetchone()
-            day_json = result[0] if result else None
-            day_record = (username, date, day_json)
-            mfp_existing_days.append(day_record)
-    return mfp_existing_days
+    logger = prefect.context.get("logger")
+    conn = get_mfp_database_connection(DB_PATH)
+    changed_days = set()
+    with sqlite_transaction(conn):
+        stored_days = conn.execute(sql.count_rawdaydata_records).fetchone()[0]
+        for record in raw_day_records:
+            query = sql.insert_or_replace_changed_rawdaydata_record
+            if conn.execute(query, record).rowcount:
+                changed_days.add((record[0], record[1]))
+        # cascading deletes of replaced days need the child indexes, so they are only
+        # dropped once all raw days are written
+        defer_indexes = (
+            bool(changed_days)
+            and len(changed_days) >= stored_days * _DEFER_INDEXES_MIN_FRACTION
+        )
+        if defer_indexes:
+            for index_name in sql.deferrable_indexes:
+                conn.execute(f"DROP INDEX IF EXISTS {index_name};")
+        for query, records in payloads.items():
+            records_to_load = (r for r in records if (r[0], r[1]) in changed_days)
+            executemany_multirow(conn, query, records_to_load)
+        if defer_indexes:
+            for create_index in sql.deferrable_indexes.values():
+                conn.execute(create_index)
+    logger.info(f"Records to Insert/Update: {len(changed_days)}")
+
+    return len(changed_days)
 
 
 @task
@@ -687,10 +689,9 @@ def mfp_select_progress_report_data(
     end_goal: int,
     num_rows_report_tbl: int,
 ) -> dict:
-    with closing(sqlite3.connect(DB_PATH)) as conn, closing(conn.cursor()) as c:
-        c.execute("PRAGMA foreign_keys = YES;")
-        c.execute(sql.select_progress_report, (user_email, starting_date, end_goal))
-        data_table = c.fetchall()
+    conn = get_mfp_database_connection(DB_PATH)
+    params = (user_email, starting_date, end_goal)
+    data_table = conn.execute(sql.select_progress_report, params).fetchall()
 
     report_data = {
         "starting_date": starting_date,
@@ -750,46 +751,94 @@ def save_email_report_locally(message: str) -> None:
         f.write(message)
 
 
-@task
-def make_dropbox_backup(
-    dbx_token: str,
-    dbx_mfp_dir: str,
-) -> dropbox.files.FileMetadata:
-    """Upload a copy of the database file to the Dropbox backup location."""
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d")
-    source_path = DB_PATH
-    dest_path = f"{dbx_mfp_dir}/mfp_db_backup_{timestamp}"
-    dbx = dropbox.Dropbox(dbx_token)
-    with open(source_path, "rb") as file:
-        res = dbx.files_upload(file.read(), dest_path, mode=WriteMode.overwrite)
-    return res
+def _upload_dropbox_file(
+    dbx: "dropbox.Dropbox", file: IO[bytes], dest_path: str
+) -> "dropbox.files.FileMetadata":
+    """Upload the open file to Dropbox in chunks, overwriting the destination."""
+    from dropbox.files import CommitInfo, UploadSessionCursor, WriteMode
+
+    chunk = file.read(_DBX_UPLOAD_CHUNK_SIZE)
+    if len(chunk) < _DBX_UPLOAD_CHUNK_SIZE:
+        return dbx.files_upload(chunk, dest_path, mode=WriteMode.overwrite)
+    session = dbx.files_upload_session_start(chunk)
+    cursor = UploadSessionCursor(session.session_id, len(chunk))
+    while chunk := file.read(_DBX_UPLOAD_CHUNK_SIZE):
+        dbx.files_upload_session_append_v2(chunk, cursor)
+        cursor.offset += len(chunk)
+    commit = CommitInfo(dest_path, mode=WriteMode.overwrite)
+    return dbx.files_upload_session_finish(b"", cursor, commit)
 
 
 @task
-def dbx_list_available_backups(
+def make_dropbox_backup(
     dbx_token: str,
     dbx_mfp_dir: str,
-) -> List[str]:
-    """Query the Dropbox backup directory for available backup files."""
-    dbx = dropbox.Dropbox(dbx_token)
-    res = dbx.files_list_folder(dbx_mfp_dir)
-    return [f.name for f in res.entries]
+) -> "dropbox.files.FileMetadata":
+    """Upload a gzipped snapshot of the database to the Dropbox backup location."""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d")
+    dest_path = f"{dbx_mfp_dir}/mfp_db_backup_{timestamp}.gz"
+    dbx = get_dropbox_client(dbx_token)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the sqlite backup API gives a consistent copy, including changes that are
+        # still in the WAL file, even while the database is being written to
+        snapshot_path = Path(tmpdir).joinpath("mfp_db_snapshot.db")
+        # read-only, so a missing database fails instead of backing up an empty one
+        with closing(
+            sqlite3.connect(f"{Path(DB_PATH).as_uri()}?mode=ro", uri=True)
+        ) as source, closing(sqlite3.connect(snapshot_path)) as snapshot:
+            source.backup(snapshot)
+        with tempfile.TemporaryFile(dir=tmpdir) as compressed:
+            with open(snapshot_path, "rb") as file, gzip.GzipFile(
+                fileobj=compressed, mode="wb", compresslevel=_BACKUP_COMPRESS_LEVEL
+            ) as gzip_file:
+                shutil.copyfileobj(file, gzip_file, _DBX_UPLOAD_CHUNK_SIZE)
+            compressed.seek(0)
+            return _upload_dropbox_file(dbx, compressed, dest_path)
 
 
 @task
 def apply_backup_rotation_scheme(
     dbx_token: str,
     dbx_mfp_dir: str,
-    files_list: List,
 ) -> List[Tuple[Any, Any]]:
-    """Apply the current backup rotation scheme (FIFO) to a provided file list."""
+    """Apply the current backup rotation scheme (FIFO) to the Dropbox backup files."""
+    from dropbox.files import DeleteArg
+
+    dbx = get_dropbox_client(dbx_token)
+    res = dbx.files_list_folder(dbx_mfp_dir)
+    files_list = [f.name for f in res.entries]
+    # large folders are listed in pages, the oldest backups can be on any of them
+    while res.has_more:
+        res = dbx.files_list_folder_continue(res.cursor)
+        files_list.extend(f.name for f in res.entries)
     #  hardcoding it to keep only the most recent 5 for now in order to see how it works.
     files_to_delete = select_fifo_backups_to_delete(5, files_list)
-    dbx = dropbox.Dropbox(dbx_token)
     if not files_to_delete:
         return []
+    # all files are deleted with a single request, which may complete asynchronously
+    job = dbx.files_delete_batch(
+        [DeleteArg(f"{dbx_mfp_dir}/{filename}") for filename in files_to_delete]
+    )
+    if job.is_async_job_id():
+        job_id = job.get_async_job_id()
+        job = dbx.files_delete_batch_check(job_id)
+        polls = 1
+        while job.is_in_progress():
+            if polls >= _DBX_BATCH_MAX_POLLS:
+                raise ValueError(
+                    f"Dropbox batch delete still in progress after {polls} checks"
+                )
+            time.sleep(_DBX_BATCH_POLL_INTERVAL)
+            job = dbx.files_delete_batch_check(job_id)
+            polls += 1
+        if job.is_failed():
+            raise ValueError(f"Dropbox batch delete failed: {job.get_failed()}")
+    if not job.is_complete():
+        raise ValueError(f"Dropbox batch delete failed: {job}")
     deleted = []
-    for filename in files_to_delete:
-        res = dbx.files_delete(f"{dbx_mfp_dir}/{filename}")
-        deleted.append((res.name, res.content_hash))
+    for entry in job.get_complete().entries:
+        if entry.is_failure():
+            raise ValueError(f"Dropbox batch delete failed: {entry.get_failure()}")
+        metadata = entry.get_success().metadata
+        deleted.append((metadata.name, metadata.content_hash))
     return deleted
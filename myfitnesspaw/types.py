@@ -17,6 +17,19 @@ class MaterializedDay:
     A class to hold the properties from myfitnesspal that we are working with.
     """
 
+    # dataclass(slots=True) needs python 3.10, the fields have no defaults so the
+    # slots can be declared by hand
+    __slots__ = (
+        "username",
+        "date",
+        "meals",
+        "exercises",
+        "goals",
+        "notes",
+        "water",
+        "measurements",
+    )
+
     username: str
     date: datetime.date
     meals: List[Meal]
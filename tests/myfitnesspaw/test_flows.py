@@ -1,6 +1,42 @@
-import pytest
+import sqlite3
+from contextlib import closing
+from datetime import date, timedelta
+from types import SimpleNamespace
 
-from myfitnesspaw import flows
+import prefect
+import pytest
+import requests
+
+from myfitnesspaw import flows, tasks
+
+
+@pytest.fixture()
+def fake_myfitnesspal_client(mocker, tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "DB_PATH", str(tmp_path.joinpath("mfp.db")))
+    fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+    mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+    fake_client = fake_client_cls.return_value
+    fake_client.get_date.return_value = SimpleNamespace(
+        meals=[],
+        exercises=[[], []],
+        goals={},
+        notes=SimpleNamespace(as_dict=lambda: {"type": "food", "body": ""}),
+        water=0.0,
+    )
+    fake_client.get_measurements.return_value = {}
+    yield fake_client_cls
+
+
+def run_etl_flow(from_date, to_date):
+    etl_flow = flows.get_etl_flow(username="testuser")
+    secrets = {
+        "MYFITNESSPAL_USERNAME_TESTUSER": "fakeuser",
+        "MYFITNESSPAL_PASSWORD_TESTUSER": "fakepassword",
+    }
+    with prefect.context(secrets=secrets):
+        return etl_flow, etl_flow.run(
+            parameters={"from_date": from_date, "to_date": to_date}
+        )
 
 
 class TestFlows:
@@ -23,6 +59,60 @@ class TestFlows:
 
         assert flow_name in f.name
 
+    def test__get_etl_flow__with_user__references_extraction_and_load_tasks(self):
+        f = flows.get_etl_flow(username="testuser")
+
+        reference_tasks = {task.name for task in f.reference_tasks()}
+
+        assert reference_tasks == {
+            "get_myfitnesspal_measurements",
+            "get_myfitnesspal_day",
+            "mfp_load_all",
+        }
+
+    def test__etl_flow__with_date_range__logs_in_once(self, fake_myfitnesspal_client):
+        etl_flow, state = run_etl_flow("2021-01-01", "2021-01-10")
+
+        load_state = state.result[etl_flow.get_tasks(name="mfp_load_all")[0]]
+        assert state.is_successful()
+        assert load_state.result == 10
+        fake_myfitnesspal_client.assert_called_once()
+        fake_myfitnesspal_client.return_value._login.assert_called_once_with()
+
+    def test__etl_flow__when_finished__closes_myfitnesspal_session(
+        self, fake_myfitnesspal_client
+    ):
+        _, state = run_etl_flow("2021-01-01", "2021-01-03")
+
+        fake_session = fake_myfitnesspal_client.return_value.session
+        assert state.is_successful()
+        fake_session.close.assert_called_once_with()
+
+    def test__etl_flow__when_measurements_fail__fails_without_replacing_days(
+        self, fake_myfitnesspal_client, monkeypatch
+    ):
+        monkeypatch.setattr(
+            tasks.get_myfitnesspal_measurements, "retry_delay", timedelta(0)
+        )
+        fake_client = fake_myfitnesspal_client.return_value
+        fake_client.get_measurements.return_value = {
+            date(2021, 1, 1): 88.8,
+            date(2021, 1, 2): 88.6,
+        }
+        _, first_state = run_etl_flow("2021-01-01", "2021-01-02")
+        fake_client.get_measurements.reset_mock(return_value=True)
+        fake_client.get_measurements.side_effect = requests.ConnectionError()
+
+        _, state = run_etl_flow("2021-01-01", "2021-01-02")
+
+        with closing(sqlite3.connect(tasks.DB_PATH)) as conn:
+            stored = conn.execute("SELECT date, value FROM Measurements;").fetchall()
+        assert first_state.is_successful()
+        assert state.is_failed()
+        # the first attempt and its five retries
+        assert fake_client.get_measurements.call_count == 6
+        assert sorted(stored) == [("2021-01-01", 88.8), ("2021-01-02", 88.6)]
+
     def test__get_progress_report_flow__without_passed_user__raises_ValueError(self):
         with pytest.raises(ValueError, match="An user must be provided for the flow"):
             flows.get_progress_report_flow(username=None)
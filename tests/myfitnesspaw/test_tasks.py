@@ -1,17 +1,23 @@
 import datetime
+import gzip
+import hashlib
 import pathlib
+import pickle
 import sqlite3
 import tempfile
+import zlib
 from contextlib import closing
 from datetime import timedelta
 
+import dropbox
 import pytest
 from prefect import Flow
 from prefect.core import Parameter
+from prefect.engine import signals
 from prefect.tasks.database.sqlite import SQLiteQuery
 
 import myfitnesspaw
-from myfitnesspaw import tasks
+from myfitnesspaw import _utils, tasks
 
 
 @pytest.fixture(scope="module")
@@ -24,15 +30,17 @@ def dbpath():
 @pytest.fixture()
 def db():
     fake_db = """
-    CREATE TABLE RawDayData (userid text, date text, rawdaydata json, PRIMARY KEY(userid, date));
+    CREATE TABLE RawDayData (userid text, date text, rawdaydata json,
+       rawdaydata_hash blob, PRIMARY KEY(userid, date)
+    );
     CREATE TABLE Water (userid text, date text, quantity real, PRIMARY KEY(userid, date),
        CONSTRAINT fk_rawdaydata FOREIGN KEY(userid, date)
        REFERENCES RawDayData(userid, date) ON DELETE CASCADE
     );
-    INSERT INTO RawDayData (userid, date, rawdaydata) VALUES
-    ('fake@fakest.com', '2021-01-01', '[{}]'),
-    ('fake@fakest.com', '2021-01-02', '[{}]'),
-    ('fake@fakest.com', '2021-01-03', '[{}]');
+    INSERT INTO RawDayData (userid, date, rawdaydata, rawdaydata_hash) VALUES
+    ('fake@fakest.com', '2021-01-01', '[{}]', x'01'),
+    ('fake@fakest.com', '2021-01-02', '[{}]', x'02'),
+    ('fake@fakest.com', '2021-01-03', '[{}]', x'03');
     INSERT INTO Water (userid, date, quantity) VALUES
     ('fake@fakest.com', '2021-01-01', 0),
     ('fake@fakest.com', '2021-01-02', 150.0),
@@ -112,7 +120,10 @@ class TestSQLiteExecuteMany:
             task = tasks.SQLiteExecuteMany(db=db)(query=query, data=data)
             select_result = SQLiteQuery(
                 db=db,
-                query="SELECT * FROM RawDayData WHERE userid = 'tester1@test.com';",
+                query=(
+                    "SELECT userid, date, rawdaydata FROM RawDayData "
+                    "WHERE userid = 'tester1@test.com';"
+                ),
             )()
 
         out = f.run()
@@ -137,7 +148,10 @@ class TestSQLiteExecuteMany:
             task_result = task(query=query, data=data)
             select_result = SQLiteQuery(
                 db=db,
-                query="SELECT * FROM RawDayData WHERE userid = 'tester1@test.com';",
+                query=(
+                    "SELECT userid, date, rawdaydata FROM RawDayData "
+                    "WHERE userid = 'tester1@test.com';"
+                ),
             )()
 
         out = f.run()
@@ -347,36 +361,53 @@ class TestETLTasks:
         assert isinstance(out.result[task].result, ValueError)
         assert "to_date cannot be before from_date" in str(out.result[task])
 
-    def test__create_mfp_database__with_no_existing_database__creates_mfp_database(
-        self, dbpath, monkeypatch
+    def test__serialize_myfitnesspal_days__with_days_list__returns_compressed_blobs(
+        self,
     ):
-        monkeypatch.setattr(tasks, "DB_PATH", dbpath)
-
+        day = myfitnesspaw.types.MaterializedDay(
+            username="fake@fakest.com",
+            date=datetime.date(2021, 1, 1),
+            meals=[],
+            exercises=[[], []],
+            goals={"calories": 2500},
+            notes={},
+            water=1500.0,
+            measurements={"Weight": 88.8},
+        )
         with Flow(name="test") as f:
-            task = tasks.create_mfp_database()
+            task = tasks.serialize_myfitnesspal_days([day])
 
         out = f.run()
 
-        expected_tables = [
-            "RawDayData",
-            "Notes",
-            "Water",
-            "Goals",
-            "Meals",
-            "MealEntries",
-            "CardioExercises",
-            "StrengthExercises",
-            "Measurements",
-        ]
-        tbl_query = "SELECT name FROM sqlite_master WHERE type='table';"
+        [(username, date, day_blob, day_hash)] = out.result[task].result
+        pickled_day = zlib.decompress(day_blob)
+        assert out.is_successful()
+        assert (username, date) == ("fake@fakest.com", datetime.date(2021, 1, 1))
+        assert pickle.loads(pickled_day) == day
+        assert day_hash == hashlib.blake2b(pickled_day, digest_size=16).digest()
 
-        with closing(sqlite3.connect(dbpath)) as conn, closing(conn.cursor()) as c:
-            c.execute(tbl_query)
-            # because tuple is returned for each table name
-            actual_tables = [res[0] for res in c.fetchall()]
+    def test__collect_extracted_days__with_failed_extractions__returns_days_only(
+        self, fake_materialized_days
+    ):
+        fetched_days = [fake_materialized_days[0], TimeoutError(), None]
+        with Flow(name="test") as f:
+            task = tasks.collect_extracted_days(fetched_days)
 
+        out = f.run()
+
+        result = out.result[task].result
         assert out.is_successful()
-        assert all(tbl in actual_tables for tbl in expected_tables)
+        assert [fake_materialized_days[0]] == result
+
+    def test__collect_extracted_days__with_failed_upstream__raises_upstream_error(
+        self,
+    ):
+        with pytest.raises(TimeoutError):
+            tasks.collect_extracted_days.run(TimeoutError())
+
+    def test__collect_extracted_days__without_results__fails(self):
+        with pytest.raises(signals.FAIL, match="The day extraction failed upstream."):
+            tasks.collect_extracted_days.run(None)
 
     def test__extract_notes__with_days_list__returns_notes_values(
         self, fake_materialized_days
@@ -411,6 +442,66 @@ class TestETLTasks:
         assert out.is_successful()
         assert expected_result == result
 
+    def test__extract_goals__with_days_list__returns_goal_values(
+        self, fake_materialized_days
+    ):
+        day = fake_materialized_days[0]
+        day.goals = {"calories": 2500, "carbohydrates": 300, "fat": 80, "protein": 150}
+        date = datetime.date(2021, 1, 1)
+        expected_result = [("fake@fakest.com", date, 2500, 300, 80, 150, None, None)]
+        with Flow(name="test") as f:
+            task = tasks.extract_goals([day])
+
+        out = f.run()
+
+        result = out.result[task].result
+        assert out.is_successful()
+        assert expected_result == result
+
+    def test__extract_day_records__with_days_list__returns_records_by_type(
+        self, mocker, fake_materialized_days
+    ):
+        day = fake_materialized_days[0]
+        totals = {
+            "calories": 100,
+            "carbohydrates": 10,
+            "fat": 5,
+            "protein": 2,
+            "sodium": 1,
+            "sugar": 3,
+        }
+        entry = mocker.Mock(short_name="egg", quantity=2.0, unit="pcs", totals=totals)
+        meal = mocker.Mock(entries=[entry], totals=totals)
+        meal.name = "breakfast"
+        cardio = mocker.Mock(
+            nutrition_information={"minutes": 30, "calories burned": 200}
+        )
+        cardio.name = "run"
+        strength = mocker.Mock(
+            nutrition_information={"sets": 3, "reps/set": 10, "weight/set": 50}
+        )
+        strength.name = "squat"
+        day.meals = [meal]
+        day.exercises = [[cardio], [strength]]
+        date = datetime.date(2021, 1, 1)
+        nutrients = (100, 10, 5, 2, 1, 3)
+        expected_result = {
+            "meals": [("fake@fakest.com", date, "breakfast", *nutrients)],
+            "mealentries": [
+                ("fake@fakest.com", date, "breakfast", "egg", 2.0, "pcs", *nutrients)
+            ],
+            "cardio_exercises": [("fake@fakest.com", date, "run", 30, 200)],
+            "strength_exercises": [("fake@fakest.com", date, "squat", 3, 10, 50)],
+        }
+        with Flow(name="test") as f:
+            task = tasks.extract_day_records([day])
+
+        out = f.run()
+
+        result = out.result[task].result
+        assert out.is_successful()
+        assert expected_result == result
+
     def test__extract_measures__with_days_list__returns_measures_values(
         self, fake_materialized_days
     ):
@@ -427,3 +518,327 @@ class TestETLTasks:
         result = out.result[task].result
         assert out.is_successful()
         assert expected_result == result
+
+
+class TestLoadTasks:
+    def test__mfp_load_all__with_new_day__inserts_all_records(self, db, monkeypatch):
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        raw_day_records = [("tester1@test.com", "2020-12-31", b"day", b"hash")]
+        payloads = {
+            "INSERT INTO Water (userid, date, quantity) VALUES (?, ?, ?);": [
+                ("tester1@test.com", "2020-12-31", 1500.0),
+            ],
+        }
+        with Flow(name="test") as f:
+            task = tasks.mfp_load_all(raw_day_records, payloads)
+
+        out = f.run()
+        _utils.close_sqlite_connections()
+
+        with closing(sqlite3.connect(db)) as conn, closing(conn.cursor()) as c:
+            c.execute("SELECT * FROM Water WHERE userid = 'tester1@test.com';")
+            result = c.fetchall()
+        assert out.is_successful()
+        assert out.result[task].result == 1
+        assert result == [("tester1@test.com", "2020-12-31", 1500.0)]
+
+    def test__mfp_load_all__with_changed_and_unchanged_days__replaces_changed_only(
+        self, db, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        raw_day_records = [
+            ("fake@fakest.com", "2021-01-01", b"day", b"\x01"),  # unchanged
+            ("fake@fakest.com", "2021-01-02", b"day", b"\xff"),  # changed
+        ]
+        payloads = {
+            "INSERT INTO Water (userid, date, quantity) VALUES (?, ?, ?);": [
+                ("fake@fakest.com", "2021-01-01", 10.0),
+                ("fake@fakest.com", "2021-01-02", 20.0),
+            ],
+        }
+        with Flow(name="test") as f:
+            task = tasks.mfp_load_all(raw_day_records, payloads)
+
+        out = f.run()
+        _utils.close_sqlite_connections()
+
+        with closing(sqlite3.connect(db)) as conn, closing(conn.cursor()) as c:
+            c.execute("SELECT date, quantity FROM Water ORDER BY date;")
+            result = c.fetchall()
+        assert out.is_successful()
+        assert out.result[task].result == 1
+        assert result == [
+            ("2021-01-01", 0),
+            ("2021-01-02", 20.0),
+            ("2021-01-03", 2230.5),
+        ]
+
+    def test__mfp_load_all__with_many_changed_days__rebuilds_deferred_indexes(
+        self, db, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        raw_day_records = [
+            ("tester1@test.com", f"2020-12-{day}", b"day", b"hash")
+            for day in range(25, 32)
+        ]
+        query = (
+            "INSERT INTO CardioExercises (userid, date, exercise_name) "
+            "VALUES (?, ?, ?);"
+        )
+        payloads = {query: [("tester1@test.com", "2020-12-31", "run")]}
+        with Flow(name="test") as f:
+            task = tasks.mfp_load_all(raw_day_records, payloads)
+
+        out = f.run()
+        _utils.close_sqlite_connections()
+
+        with closing(sqlite3.connect(db)) as conn, closing(conn.cursor()) as c:
+            c.execute("SELECT exercise_name FROM CardioExercises;")
+            result = c.fetchall()
+            c.execute("SELECT name FROM sqlite_master WHERE type='index';")
+            indexes = [row[0] for row in c.fetchall()]
+        assert out.is_successful()
+        assert result == [("run",)]
+        assert all(index in indexes for index in myfitnesspaw.sql.deferrable_indexes)
+
+    def test__mfp_load_all__with_few_changed_days__keeps_indexes(self, db, monkeypatch):
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        raw_day_records = [("tester1@test.com", "2020-12-31", b"day", b"hash")]
+        statements = []
+        conn = _utils.get_mfp_database_connection(db)
+        conn.set_trace_callback(statements.append)
+        with Flow(name="test") as f:
+            task = tasks.mfp_load_all(raw_day_records, {})
+
+        out = f.run()
+        _utils.close_sqlite_connections()
+
+        assert out.is_successful()
+        assert not any("DROP INDEX" in statement for statement in statements)
+
+    def test__mfp_load_all__when_a_query_fails__rolls_back_all_records(
+        self, db, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        raw_day_records = [("tester1@test.com", "2020-12-31", b"day", b"hash")]
+        payloads = {
+            "INSERT INTO Water (userid, date, quantity) VALUES (?, ?, ?);": [
+                ("tester1@test.com", "2020-12-31", 1500.0),
+                ("tester1@test.com", "2020-12-31", 1500.0),  # violates primary key
+            ],
+        }
+        with Flow(name="test") as f:
+            task = tasks.mfp_load_all(raw_day_records, payloads)
+
+        out = f.run()
+        _utils.close_sqlite_connections()
+
+        with closing(sqlite3.connect(db)) as conn, closing(conn.cursor()) as c:
+            c.execute("SELECT * FROM RawDayData WHERE userid = 'tester1@test.com';")
+            result = c.fetchall()
+        assert out.is_failed()
+        assert result == []
+
+
+class TestBackupTasks:
+    def test__apply_backup_rotation_scheme__with_async_batch__deletes_oldest(
+        self, mocker, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "_DBX_BATCH_POLL_INTERVAL", 0)
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        fake_dbx.files_delete_batch.return_value = (
+            dropbox.files.DeleteBatchLaunch.async_job_id("fakejob")
+        )
+        content_hash = "f" * 64
+        deleted_file = dropbox.files.FileMetadata(
+            name="mfp_db_backup_2021-01-01", content_hash=content_hash
+        )
+        fake_dbx.files_delete_batch_check.side_effect = [
+            dropbox.files.DeleteBatchJobStatus("in_progress"),
+            dropbox.files.DeleteBatchJobStatus.complete(
+                dropbox.files.DeleteBatchResult(
+                    entries=[
+                        dropbox.files.DeleteBatchResultEntry.success(
+                            dropbox.files.DeleteBatchResultData(deleted_file)
+                        )
+                    ]
+                )
+            ),
+        ]
+        fake_dbx.files_list_folder.return_value = dropbox.files.ListFolderResult(
+            entries=[
+                dropbox.files.FileMetadata(name=f"mfp_db_backup_2021-01-0{day}")
+                for day in range(1, 7)
+            ],
+            cursor="fakecursor",
+            has_more=False,
+        )
+        with Flow(name="test") as f:
+            task = tasks.apply_backup_rotation_scheme("faketoken", "/backups")
+
+        out = f.run()
+
+        result = out.result[task].result
+        assert out.is_successful()
+        assert result == [("mfp_db_backup_2021-01-01", content_hash)]
+        fake_dbx.files_list_folder.assert_called_once_with("/backups")
+        fake_dbx.files_delete_batch.assert_called_once_with(
+            [dropbox.files.DeleteArg("/backups/mfp_db_backup_2021-01-01")]
+        )
+        fake_dbx.files_delete_batch_check.assert_called_with("fakejob")
+
+    def test__apply_backup_rotation_scheme__with_stuck_batch__fails_after_max_polls(
+        self, mocker, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "_DBX_BATCH_POLL_INTERVAL", 0)
+        monkeypatch.setattr(tasks, "_DBX_BATCH_MAX_POLLS", 3)
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        fake_dbx.files_delete_batch.return_value = (
+            dropbox.files.DeleteBatchLaunch.async_job_id("fakejob")
+        )
+        fake_dbx.files_delete_batch_check.return_value = (
+            dropbox.files.DeleteBatchJobStatus("in_progress")
+        )
+        fake_dbx.files_list_folder.return_value = dropbox.files.ListFolderResult(
+            entries=[
+                dropbox.files.FileMetadata(name=f"mfp_db_backup_2021-01-0{day}")
+                for day in range(1, 7)
+            ],
+            cursor="fakecursor",
+            has_more=False,
+        )
+        with Flow(name="test") as f:
+            task = tasks.apply_backup_rotation_scheme("faketoken", "/backups")
+
+        out = f.run()
+
+        assert out.is_failed()
+        assert "still in progress after 3 checks" in str(out.result[task].result)
+        assert fake_dbx.files_delete_batch_check.call_count == 3
+
+    def test__apply_backup_rotation_scheme__with_failed_batch__fails(
+        self, mocker, monkeypatch
+    ):
+        monkeypatch.setattr(tasks, "_DBX_BATCH_POLL_INTERVAL", 0)
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        fake_dbx.files_delete_batch.return_value = (
+            dropbox.files.DeleteBatchLaunch.async_job_id("fakejob")
+        )
+        fake_dbx.files_delete_batch_check.return_value = (
+            dropbox.files.DeleteBatchJobStatus.failed(
+                dropbox.files.DeleteBatchError("too_many_write_operations")
+            )
+        )
+        fake_dbx.files_list_folder.return_value = dropbox.files.ListFolderResult(
+            entries=[
+                dropbox.files.FileMetadata(name=f"mfp_db_backup_2021-01-0{day}")
+                for day in range(1, 7)
+            ],
+            cursor="fakecursor",
+            has_more=False,
+        )
+        with Flow(name="test") as f:
+            task = tasks.apply_backup_rotation_scheme("faketoken", "/backups")
+
+        out = f.run()
+
+        assert out.is_failed()
+        assert "Dropbox batch delete failed" in str(out.result[task].result)
+
+    def test__make_dropbox_backup__with_open_writer__uploads_gzip_snapshot_in_chunks(
+        self, mocker, monkeypatch, tmp_path
+    ):
+        db = tmp_path.joinpath("mfp_test.db")
+        # the writer stays open, so the committed row is still only in the WAL file
+        writer = sqlite3.connect(db)
+        writer.execute("PRAGMA journal_mode = WAL;")
+        writer.execute("CREATE TABLE Backup (payload text);")
+        writer.execute("INSERT INTO Backup VALUES ('backed up');")
+        writer.commit()
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        monkeypatch.setattr(tasks, "_DBX_UPLOAD_CHUNK_SIZE", 4)
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        fake_dbx.files_upload_session_start.return_value.session_id = "fakesession"
+        with Flow(name="test") as f:
+            task = tasks.make_dropbox_backup("faketoken", "/backups")
+
+        out = f.run()
+        writer.close()
+
+        assert out.is_successful()
+        fake_dbx.files_upload.assert_not_called()
+        first_chunk = fake_dbx.files_upload_session_start.call_args.args[0]
+        appended = fake_dbx.files_upload_session_append_v2.call_args_list
+        uploaded = first_chunk + b"".join(call.args[0] for call in appended)
+        snapshot = tmp_path.joinpath("snapshot.db")
+        snapshot.write_bytes(gzip.decompress(uploaded))
+        with closing(sqlite3.connect(snapshot)) as conn:
+            assert conn.execute("SELECT * FROM Backup;").fetchall() == [("backed up",)]
+        assert all(len(call.args[0]) <= 4 for call in appended)
+        chunk, cursor, commit = fake_dbx.files_upload_session_finish.call_args.args
+        assert (chunk, cursor.session_id, cursor.offset) == (
+            b"",
+            "fakesession",
+            len(uploaded),
+        )
+        assert commit.path.startswith("/backups/mfp_db_backup_")
+        assert commit.path.endswith(".gz")
+        finished = fake_dbx.files_upload_session_finish.return_value
+        assert out.result[task].result is finished
+
+    def test__apply_backup_rotation_scheme__with_paged_listing__lists_all_pages(
+        self, mocker
+    ):
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        fake_dbx.files_list_folder.return_value = dropbox.files.ListFolderResult(
+            entries=[
+                dropbox.files.FileMetadata(name=f"mfp_db_backup_2021-01-0{day}")
+                for day in range(2, 7)
+            ],
+            cursor="fakecursor",
+            has_more=True,
+        )
+        fake_dbx.files_list_folder_continue.return_value = (
+            dropbox.files.ListFolderResult(
+                entries=[dropbox.files.FileMetadata(name="mfp_db_backup_2021-01-01")],
+                cursor="fakecursor",
+                has_more=False,
+            )
+        )
+        fake_dbx.files_delete_batch.return_value = (
+            dropbox.files.DeleteBatchLaunch.complete(
+                dropbox.files.DeleteBatchResult(entries=[])
+            )
+        )
+        with Flow(name="test") as f:
+            task = tasks.apply_backup_rotation_scheme("faketoken", "/backups")
+
+        out = f.run()
+
+        assert out.is_successful()
+        fake_dbx.files_list_folder_continue.assert_called_once_with("fakecursor")
+        fake_dbx.files_delete_batch.assert_called_once_with(
+            [dropbox.files.DeleteArg("/backups/mfp_db_backup_2021-01-01")]
+        )
+
+    def test__make_dropbox_backup__without_database__fails_without_upload(
+        self, mocker, monkeypatch, tmp_path
+    ):
+        db = tmp_path.joinpath("missing.db")
+        monkeypatch.setattr(tasks, "DB_PATH", db)
+        fake_dbx = mocker.patch("dropbox.Dropbox").return_value
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        with Flow(name="test") as f:
+            task = tasks.make_dropbox_backup("faketoken", "/backups")
+
+        out = f.run()
+
+        assert out.is_failed()
+        assert not db.exists()
+        fake_dbx.files_upload.assert_not_called()
+        fake_dbx.files_upload_session_start.assert_not_called()
@@ -1,5 +1,26 @@
+import datetime
+import sqlite3
+from contextlib import closing
+
 import pytest
+import requests
 
+import myfitnesspaw.sql
+from myfitnesspaw import _utils
+from myfitnesspaw._utils import (
+    batched,
+    close_dropbox_clients,
+    close_myfitnesspal_clients,
+    close_sqlite_connections,
+    executemany_multirow,
+    get_dropbox_client,
+    get_mfp_database_connection,
+    get_myfitnesspal_client,
+    get_sqlite_connection,
+    select_fifo_backups_to_delete,
+    sqlite_transaction,
+    try_parse_date_str,
+)
 from myfitnesspaw.tasks import MyfitnesspalClientAdapter
 
 
@@ -22,4 +43,376 @@ class TestMyFitnesspalClientAdapter:
         fake_myfitnesspal.Client.return_value = fake_client
 
         with MyfitnesspalClientAdapter("fakeuser", "fakepassword") as mfp_adapter:
-            assert fake_client is mfp_adapter._client
+            assert fake_client is mfp_adapter.client
+
+    def test__init__with_credentials__does_not_log_in(self, mocker):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+
+        with MyfitnesspalClientAdapter("fakeuser", "fakepassword"):
+            pass
+
+        fake_client_cls.assert_not_called()
+
+    def test__init__with_same_credentials__reuses_logged_in_client(self, mocker):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+
+        first_adapter = MyfitnesspalClientAdapter("fakeuser", "fakepassword")
+        second_adapter = MyfitnesspalClientAdapter("fakeuser", "fakepassword")
+
+        assert first_adapter.client is second_adapter.client
+        fake_client_cls.assert_called_once_with("fakeuser", "fakepassword", login=False)
+        fake_client_cls.return_value._login.assert_called_once_with()
+
+    def test__get_myfitnesspal_client__with_credentials__logs_in_with_timeout(
+        self, mocker
+    ):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        fake_response = requests.Response()
+        fake_response.status_code = 200
+        fake_send = mocker.patch(
+            "requests.adapters.HTTPAdapter.send", return_value=fake_response
+        )
+        fake_client = fake_client_cls.return_value
+        fake_client.session = requests.Session()
+        fake_client._login.side_effect = lambda: fake_client.session.get(
+            "https://www.myfitnesspal.com/"
+        )
+
+        get_myfitnesspal_client("fakeuser", "fakepassword")
+
+        assert fake_send.call_args.kwargs["timeout"] == (
+            _utils._MYFITNESSPAL_REQUEST_TIMEOUT
+        )
+
+    def test__get_myfitnesspal_client__while_logging_in__serves_other_accounts(
+        self, mocker
+    ):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_login_locks", clear=True)
+        first_client, second_client = mocker.Mock(), mocker.Mock()
+        fake_client_cls.side_effect = [first_client, second_client]
+        clients_during_login = []
+        # the other account is looked up while the first login is still in progress
+        first_client._login.side_effect = lambda: clients_during_login.append(
+            get_myfitnesspal_client("otheruser", "otherpassword")
+        )
+
+        client = get_myfitnesspal_client("fakeuser", "fakepassword")
+
+        assert client is first_client
+        assert clients_during_login == [second_client]
+
+    def test__close_myfitnesspal_clients__with_shared_client__closes_session(
+        self, mocker
+    ):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        with MyfitnesspalClientAdapter("fakeuser", "fakepassword") as mfp_adapter:
+            mfp_adapter.client
+
+        close_myfitnesspal_clients()
+
+        fake_client_cls.return_value.session.close.assert_called_once_with()
+        assert MyfitnesspalClientAdapter("fakeuser", "fakepassword").client
+        assert fake_client_cls.call_count == 2
+
+    def test__get_measurements__with_date_range__requests_each_measure_once(
+        self, mocker
+    ):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        fake_client = fake_client_cls.return_value
+        fake_responses = {"Weight": {"2021-01-02": 88.0, "2021-01-01": 88.8}}
+
+        def fake_get_measurements(measure, from_date, to_date):
+            if measure not in fake_responses:
+                raise ValueError()
+            return fake_responses[measure]
+
+        fake_client.get_measurements.side_effect = fake_get_measurements
+
+        with MyfitnesspalClientAdapter("fakeuser", "fakepassword") as mfp_adapter:
+            result = mfp_adapter.get_measurements(
+                "2021-01-01", "2021-01-03", ["Weight", "Height"]
+            )
+
+        assert result == {"Weight": {"2021-01-02": 88.0, "2021-01-01": 88.8}}
+        assert fake_client.get_measurements.call_count == 2
+        fake_client.get_measurements.assert_has_calls(
+            [
+                mocker.call("Weight", "2021-01-01", "2021-01-03"),
+                mocker.call("Height", "2021-01-01", "2021-01-03"),
+            ],
+            any_order=True,
+        )
+
+    def test__get_measurements__with_missing_measure__logs_missing_measure(
+        self, mocker, caplog
+    ):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        fake_client = fake_client_cls.return_value
+        fake_client.get_measurements.side_effect = ValueError()
+
+        with MyfitnesspalClientAdapter("fakeuser", "fakepassword") as mfp_adapter:
+            result = mfp_adapter.get_measurements(
+                "2021-01-01", "2021-01-03", ["Height"]
+            )
+
+        assert result == {}
+        assert "No measure records found for: Height" in caplog.text
+
+    def test__get_measurements__when_a_measure_fails__raises(self, mocker):
+        fake_client_cls = mocker.patch("myfitnesspaw._utils.myfitnesspal.Client")
+        mocker.patch.dict("myfitnesspaw._utils._myfitnesspal_clients", clear=True)
+        fake_client = fake_client_cls.return_value
+
+        def fake_get_measurements(measure, from_date, to_date):
+            if measure == "Height":
+                raise requests.ConnectionError("connection reset")
+            return {"2021-01-01": 88.8}
+
+        fake_client.get_measurements.side_effect = fake_get_measurements
+
+        with MyfitnesspalClientAdapter("fakeuser", "fakepassword") as mfp_adapter:
+            with pytest.raises(requests.ConnectionError, match="connection reset"):
+                mfp_adapter.get_measurements(
+                    "2021-01-01", "2021-01-03", ["Weight", "Height"]
+                )
+
+
+class TestDropboxClient:
+    def test__get_dropbox_client__with_same_token__reuses_client(self, mocker):
+        fake_dropbox_cls = mocker.patch("dropbox.Dropbox")
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+
+        client = get_dropbox_client("faketoken")
+
+        assert get_dropbox_client("faketoken") is client
+        fake_dropbox_cls.assert_called_once_with("faketoken")
+
+    def test__close_dropbox_clients__with_shared_client__closes_client(self, mocker):
+        fake_dropbox_cls = mocker.patch("dropbox.Dropbox")
+        mocker.patch.dict("myfitnesspaw._utils._dropbox_clients", clear=True)
+        get_dropbox_client("faketoken")
+
+        close_dropbox_clients()
+
+        fake_dropbox_cls.return_value.close.assert_called_once_with()
+        get_dropbox_client("faketoken")
+        assert fake_dropbox_cls.call_count == 2
+
+
+class TestSQLiteConnection:
+    def test__get_sqlite_connection__called_twice__returns_shared_connection(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        try:
+            assert get_sqlite_connection(db) is get_sqlite_connection(str(db))
+        finally:
+            close_sqlite_connections()
+
+    def test__get_sqlite_connection__with_new_database__uses_wal_journal(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        try:
+            conn = get_sqlite_connection(db)
+            journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+        finally:
+            close_sqlite_connections()
+
+        assert journal_mode == "wal"
+
+    def test__get_sqlite_connection__with_new_database__enforces_foreign_keys(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        try:
+            conn = get_sqlite_connection(db)
+            foreign_keys = conn.execute("PRAGMA foreign_keys;").fetchone()[0]
+        finally:
+            close_sqlite_connections()
+
+        assert foreign_keys == 1
+
+    def test__sqlite_transaction__when_block_raises__rolls_back(self, tmp_path):
+        db = tmp_path.joinpath("test.db")
+        try:
+            conn = get_sqlite_connection(db)
+            conn.execute("CREATE TABLE T (value INTEGER);")
+            with pytest.raises(RuntimeError):
+                with sqlite_transaction(conn):
+                    conn.execute("INSERT INTO T (value) VALUES (1);")
+                    raise RuntimeError()
+            result = conn.execute("SELECT * FROM T;").fetchall()
+        finally:
+            close_sqlite_connections()
+
+        assert result == []
+
+    def test__get_mfp_database_connection__with_no_existing_database__creates_tables(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        expected_tables = [
+            "RawDayData",
+            "Notes",
+            "Water",
+            "Goals",
+            "Meals",
+            "MealEntries",
+            "CardioExercises",
+            "StrengthExercises",
+            "Measurements",
+        ]
+        tbl_query = "SELECT name FROM sqlite_master WHERE type='table';"
+        try:
+            conn = get_mfp_database_connection(db)
+            actual_tables = [res[0] for res in conn.execute(tbl_query).fetchall()]
+        finally:
+            close_sqlite_connections()
+
+        assert all(tbl in actual_tables for tbl in expected_tables)
+
+    def test__get_mfp_database_connection__with_no_existing_database__creates_indexes(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        expected_indexes = [
+            "idx_mealentries_meal",
+            "idx_cardioexercises_day",
+            "idx_strengthexercises_day",
+        ]
+        idx_query = "SELECT name FROM sqlite_master WHERE type='index';"
+        try:
+            conn = get_mfp_database_connection(db)
+            actual_indexes = [res[0] for res in conn.execute(idx_query).fetchall()]
+        finally:
+            close_sqlite_connections()
+
+        assert all(idx in actual_indexes for idx in expected_indexes)
+
+    def test__get_mfp_database_connection__with_missing_directory__creates_it(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("database", "test.db")
+        try:
+            get_mfp_database_connection(db)
+        finally:
+            close_sqlite_connections()
+
+        assert db.exists()
+
+    def test__get_mfp_database_connection__with_current_schema__skips_schema_script(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        with closing(sqlite3.connect(db)) as conn:
+            conn.execute(f"PRAGMA user_version = {myfitnesspaw.sql.schema_version};")
+        try:
+            conn = get_mfp_database_connection(db)
+            tables = conn.execute("SELECT name FROM sqlite_master;").fetchall()
+        finally:
+            close_sqlite_connections()
+
+        assert tables == []
+
+    def test__get_mfp_database_connection__with_database_without_hashes__adds_column(
+        self, tmp_path
+    ):
+        db = tmp_path.joinpath("test.db")
+        with closing(sqlite3.connect(db)) as conn:
+            conn.execute(
+                "CREATE TABLE RawDayData (userid text, date text, rawdaydata json, "
+                "PRIMARY KEY(userid, date));"
+            )
+        try:
+            conn = get_mfp_database_connection(db)
+            columns = conn.execute("PRAGMA table_info(RawDayData);").fetchall()
+        finally:
+            close_sqlite_connections()
+
+        assert "rawdaydata_hash" in [column[1] for column in columns]
+
+
+class TestBatched:
+    def test__batched__with_remainder__returns_short_last_batch(self):
+        assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+    def test__batched__with_empty_iterable__returns_no_batches(self):
+        assert list(batched([], 2)) == []
+
+
+class TestExecuteManyMultirow:
+    def test__executemany_multirow__with_more_rows_than_a_statement__inserts_all(self):
+        records = [(i, str(i)) for i in range(5)]
+        with closing(sqlite3.connect(":memory:")) as conn:
+            conn.execute("CREATE TABLE T (id INTEGER, name TEXT);")
+            executemany_multirow(
+                conn, "INSERT INTO T (id, name) VALUES (?, ?);", records, max_params=4
+            )
+            result = conn.execute("SELECT * FROM T ORDER BY id;").fetchall()
+
+        assert result == records
+
+    def test__executemany_multirow__without_values_clause__raises_ValueError(self):
+        expected_error_msg = "The query must be an INSERT ... VALUES"
+        with closing(sqlite3.connect(":memory:")) as conn:
+            with pytest.raises(ValueError, match=expected_error_msg):
+                executemany_multirow(conn, "DELETE FROM T;", [(1,)])
+
+
+class TestTryParseDateStr:
+    @pytest.mark.parametrize("date_str", ["2021-01-05", "2021-1-5", "05.01.2021"])
+    def test__try_parse_date_str__with_available_format__returns_datetime(
+        self, date_str
+    ):
+        assert try_parse_date_str(date_str) == datetime.datetime(2021, 1, 5)
+
+    @pytest.mark.parametrize("date_str", ["2021/01/05", "20210105", "2021-W01-2"])
+    def test__try_parse_date_str__with_unknown_format__raises_ValueError(
+        self, date_str
+    ):
+        expected_error_msg = f"No available format found to parse <{date_str}>."
+        with pytest.raises(ValueError, match=expected_error_msg):
+            try_parse_date_str(date_str)
+
+
+class TestSelectFifoBackupsToDelete:
+    def test__select_fifo_backups_to_delete__with_too_many_backups__returns_oldest(
+        self,
+    ):
+        files_list = [
+            "mfp_db_backup_2021-03-01",
+            "mfp_db_backup_2020-12-31",
+            "mfp_db_backup_2021-01-15",
+            "mfp_db_backup_2021-02-01",
+        ]
+
+        result = select_fifo_backups_to_delete(2, files_list)
+
+        assert result == ["mfp_db_backup_2020-12-31", "mfp_db_backup_2021-01-15"]
+
+    def test__select_fifo_backups_to_delete__within_limit__returns_empty_list(self):
+        files_list = ["mfp_db_backup_2021-03-01", "mfp_db_backup_2020-12-31"]
+
+        assert select_fifo_backups_to_delete(2, files_list) == []
+
+    def test__select_fifo_backups_to_delete__with_gzipped_backups__returns_oldest(
+        self,
+    ):
+        files_list = [
+            "mfp_db_backup_2021-03-01.gz",
+            "mfp_db_backup_2021-02-28.gz",
+            "mfp_db_backup_2021-01-15",
+        ]
+
+        result = select_fifo_backups_to_delete(2, files_list)
+
+        assert result == ["mfp_db_backup_2021-01-15"]